@@ -1,39 +1,27 @@
 # app.py — نسخة ملف واحد تجمع الواجهة + API + الفاحص + التصدير
 # تشغيل: uvicorn app:app --reload
 
-import json, uuid, html
+import time
+_IMPORT_T0 = time.perf_counter()   # لقياس زمن الإقلاع البارد
+
+import json, uuid, html, math, os, hashlib, sys, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
 from typing import Optional, List, Dict, Any, Tuple
 
 # ===== مكتبات خارجية =====
+# ملاحظة: matplotlib وإضافة الرسم في ezdxf و reportlab و openpyxl ثقيلة،
+# فتُستورد داخل الدوال التي تحتاجها فقط (انظري warm_heavy_imports).
+import numpy as np
 import ezdxf
+from ezdxf.math import ConstructionEllipse, Vec3
+from ezdxf.addons import iterdxf
+from ezdxf.entities.subentity import entity_linker
 from fastapi import FastAPI, Request, UploadFile, Form
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
-# للتصدير
-from openpyxl import Workbook
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
-from reportlab.pdfgen import canvas
-
-# للمعاينة (PNG باستخدام matplotlib backend)
-import matplotlib.pyplot as plt
-from ezdxf.addons.drawing import Frontend, RenderContext
-from ezdxf.addons.drawing.matplotlib import MatplotlibBackend
-# ===== إنشاء تطبيق FastAPI =====
-app = FastAPI(
-    title="DWG/IFC Checker",
-    docs_url="/docs",
-    redoc_url=None
-)
-
-# مسار فحص سريع للصحة (مفيد للنشر)
-@app.get("/healthz")
-def health():
-    return {"status": "ok"}
-
-
 # ================= إعداد المسارات =================
 BASE = Path(__file__).parent.resolve()
 UPLOADS = BASE / "uploads"
@@ -46,20 +34,173 @@ for d in (UPLOADS, RESULTS, STATIC):
 # بإمكانك وضع logo وملف التعليمات داخل مجلد static إن رغبتِ
 # مثال: STATIC/logo.png و STATIC/instructions.pdf
 
-app = FastAPI(title="DXF Checker")
+# ===== الإقلاع: تحميل المكتبات الثقيلة في الخلفية بعد بدء الخادم =====
+WARMUP_IMPORTS: bool = os.environ.get("WARMUP_IMPORTS", "1") != "0"
+STARTUP: Dict[str, Any] = {"import_s": None, "ready_s": None, "warm_s": None}
+
+def warm_heavy_imports():
+    """يستورد مكتبات المعاينة والتصدير مسبقًا حتى لا يدفع أول طلب ثمنها."""
+    t0 = time.perf_counter()
+    try:
+        import matplotlib.pyplot  # noqa: F401
+        import ezdxf.addons.drawing.matplotlib  # noqa: F401
+        import openpyxl  # noqa: F401
+        import reportlab.pdfgen.canvas  # noqa: F401
+    except Exception:
+        return
+    STARTUP["warm_s"] = round(time.perf_counter() - t0, 3)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    STARTUP["ready_s"] = round(time.perf_counter() - _IMPORT_T0, 3)
+    if WARMUP_IMPORTS:
+        threading.Thread(target=warm_heavy_imports, name="warmup", daemon=True).start()
+    yield
+    shutdown_job_pool()
+
+# ===== إنشاء تطبيق FastAPI =====
+app = FastAPI(
+    title="DWG/IFC Checker",
+    docs_url="/docs",
+    redoc_url=None,
+    lifespan=lifespan,
+)
 app.mount("/static", StaticFiles(directory=str(STATIC)), name="static")
 app.mount("/results", StaticFiles(directory=str(RESULTS)), name="results")
 
+# مسار فحص سريع للصحة (مفيد للنشر)
+@app.get("/healthz")
+def health():
+    return {"status": "ok", "startup": STARTUP}
+
+# ===== حدود الرفع =====
+MAX_UPLOAD_MB: int = int(os.environ.get("MAX_UPLOAD_MB", "512"))
+MAX_UPLOAD_BYTES: int = MAX_UPLOAD_MB * 1024 * 1024
+UPLOAD_CHUNK: int = 1024 * 1024     # 1 MiB لكل قطعة
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    # رفض مبكر قبل قراءة الجسم إذا صرّح العميل بحجم أكبر من المسموح
+    if request.method == "POST" and request.url.path == "/upload-cad":
+        try:
+            length = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            length = 0
+        if length > MAX_UPLOAD_BYTES + UPLOAD_CHUNK:  # هامش لحقول النموذج
+            return HTMLResponse(f"الملف أكبر من الحد المسموح ({MAX_UPLOAD_MB} MB).", status_code=413)
+    return await call_next(request)
+
+async def save_upload_stream(upload: UploadFile, dest: Path,
+                             max_bytes: int = MAX_UPLOAD_BYTES) -> Optional[Tuple[int, str]]:
+    """
+    ينسخ الملف المرفوع إلى dest على قطع ثابتة الحجم مع حساب SHA-256 أثناء النسخ.
+    يرجع (الحجم، البصمة)، أو None إذا تجاوز max_bytes (ويُحذف الجزء المكتوب).
+    """
+    h = hashlib.sha256()
+    size = 0
+    tmp = dest.with_name(dest.name + ".part")
+    try:
+        with open(tmp, "wb") as f:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    break
+                h.update(chunk)
+                f.write(chunk)
+        if size > max_bytes:
+            tmp.unlink(missing_ok=True)
+            return None
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return size, h.hexdigest()
+
 def safe_json_dump(p: Path, data: dict):
-    p.write_text(json.dumps(data, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+    # كتابة ذرّية: الصفحة قد تقرأ الملف أثناء كتابة المهمة له
+    tmp = p.with_name(p.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+    os.replace(tmp, p)
 
 def safe_json_load(p: Path) -> dict:
     return json.loads(p.read_text(encoding="utf-8"))
 
-def generate_preview(dxf_path: Path, out_png: Path) -> tuple[bool,str]:
-    """يحاول رسم Layout الأول كصورة PNG."""
+# ================= التوقيت والمقاييس (Prometheus) =================
+@contextmanager
+def timed(timings: Optional[Dict[str, float]], stage: str):
+    """يقيس زمن مرحلة ويضيفه إلى timings (بالثواني)."""
+    t0 = time.perf_counter()
     try:
-        doc = ezdxf.readfile(str(dxf_path))
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + time.perf_counter() - t0, 4)
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+COUNT_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+# مقاييس لكل عملية (كل عامل uvicorn له مقاييسه؛ Prometheus يجمعها حسب instance)
+_metrics_lock = threading.Lock()
+_histograms: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_counters: Dict[Tuple[str, str], float] = {}
+
+def _labels(**labels) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+def observe(name: str, value: float, buckets=STAGE_BUCKETS, **labels):
+    key = (name, _labels(**labels))
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, b in enumerate(h["buckets"]):
+            if value <= b:
+                h["counts"][i] += 1
+        h["sum"] += value
+        h["count"] += 1
+
+def inc_counter(name: str, value: float = 1.0, **labels):
+    key = (name, _labels(**labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+def observe_timings(timings: Dict[str, float]):
+    for stage, seconds in timings.items():
+        observe("dxf_checker_stage_seconds", seconds, stage=stage)
+
+def render_metrics() -> str:
+    """نص المقاييس بصيغة Prometheus (text exposition 0.0.4)."""
+    lines: List[str] = []
+    with _metrics_lock:
+        typed = set()
+        for (name, labels), h in sorted(_histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram"); typed.add(name)
+            sep = "," if labels else ""
+            for b, c in zip(h["buckets"], h["counts"]):
+                lines.append(f'{name}_bucket{{{labels}{sep}le="{b}"}} {c}')
+            lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {h["count"]}')
+            lab = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{lab} {h['sum']}")
+            lines.append(f"{name}_count{lab} {h['count']}")
+        for (name, labels), v in sorted(_counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter"); typed.add(name)
+            lab = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}{lab} {v}")
+    return "\n".join(lines) + "\n"
+
+def generate_preview(dxf_path: Path, out_png: Path, doc=None) -> tuple[bool,str]:
+    """يحاول رسم Layout الأول كصورة PNG (يعيد استخدام doc إن مُرّر)."""
+    import matplotlib.pyplot as plt
+    from ezdxf.addons.drawing import Frontend, RenderContext
+    from ezdxf.addons.drawing.matplotlib import MatplotlibBackend
+    try:
+        if doc is None:
+            doc = ezdxf.readfile(str(dxf_path))
         msp = doc.modelspace()
         ctx = RenderContext(doc)
 
@@ -177,6 +318,134 @@ def point_in_or_on_polygon_or_near(x: float, y: float, poly,
     # قريب من الحد
     return distance_point_to_polygon(x, y, poly) <= edge_eps
 
+# ===== نواة NumPy: كل نقاط الباب مقابل كل أضلاع الغرفة دفعة واحدة =====
+# الدوال السابقة (لكل نقطة ولكل ضلع) تبقى المرجع؛ هذه تعطي نفس النتيجة بنفس العمليات.
+NP_KERNEL_MIN_WORK: int = 96   # (نقاط × أضلاع) أقل من هذا ← الحلقة العادية أسرع
+def polygon_array(points: List[Tuple[float,float]]) -> np.ndarray:
+    """الغرفة كمصفوفة (N,2) مغلقة (أول نقطة = آخر نقطة)."""
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+def points_match_polygon_np(pts: np.ndarray, poly: np.ndarray,
+                            eps: float = EPS, edge_eps: float = EDGE_EPS) -> np.ndarray:
+    """
+    لكل نقطة في pts (M,2): هل هي على حد poly (N,2 مغلق) أو داخله أو قريبة منه؟
+    يعادل point_in_or_on_polygon_or_near نقطةً نقطة، ويرجع مصفوفة bool بطول M.
+    """
+    m = len(pts)
+    if len(poly) < 2 or m == 0:
+        return np.zeros(m, dtype=bool)
+    px = pts[:, 0:1]; py = pts[:, 1:2]                  # (M,1)
+    x1 = poly[:-1, 0]; y1 = poly[:-1, 1]                 # (E,)
+    x2 = poly[1:, 0];  y2 = poly[1:, 1]
+    dx = x2 - x1; dy = y2 - y1
+
+    # على الحد
+    in_box = ((np.minimum(x1, x2) - eps <= px) & (px <= np.maximum(x1, x2) + eps) &
+              (np.minimum(y1, y2) - eps <= py) & (py <= np.maximum(y1, y2) + eps))
+    area2 = np.abs(dx * (py - y1) - (px - x1) * dy)
+    ok = np.any(in_box & (area2 <= eps), axis=1)
+    if ok.all():
+        return ok
+
+    # داخل (زوجي-فردي)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crosses = (y1 > py) != (y2 > py)
+        xinters = dx * (py - y1) / (dy + 1e-12) + x1
+        hits = crosses & (xinters >= px - eps)
+    ok |= np.count_nonzero(hits, axis=1) % 2 == 1
+    if ok.all():
+        return ok
+
+    # قريب من الحد
+    with np.errstate(divide="ignore", invalid="ignore"):
+        seg2 = dx * dx + dy * dy
+        t = ((px - x1) * dx + (py - y1) * dy) / seg2
+        t = np.where(seg2 == 0, 0.0, np.clip(t, 0.0, 1.0))
+    d = np.sqrt((px - (x1 + t * dx)) ** 2 + (py - (y1 + t * dy)) ** 2)
+    return ok | np.any(d <= edge_eps, axis=1)
+
+def points_in_or_on_polygon_or_near_np(pts: np.ndarray, poly: np.ndarray,
+                                       eps: float = EPS, edge_eps: float = EDGE_EPS) -> bool:
+    """يعادل any(point_in_or_on_polygon_or_near(x, y, poly) for x, y in pts)."""
+    return bool(points_match_polygon_np(pts, poly, eps, edge_eps).any())
+
+# ===== فهرس مكاني (شبكة منتظمة) لمطابقة الأبواب مع الغرف =====
+GRID_MAX_CELLS_PER_ROOM: int = 256
+
+def polygon_bbox(poly, pad: float = 0.0) -> Tuple[float, float, float, float]:
+    xs = [p[0] for p in poly]; ys = [p[1] for p in poly]
+    return min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad
+
+def build_room_grid(rooms: List[Dict[str, Any]], pad: float) -> Dict[str, Any]:
+    """
+    يبني شبكة منتظمة فوق صناديق الغرف (موسّعة بـ pad).
+    كل خلية تحمل أرقام الغرف التي يتقاطع صندوقها معها.
+    """
+    boxes = [polygon_bbox(r["points"], pad) if r["points"] else None for r in rooms]
+    valid = [b for b in boxes if b]
+    if not valid:
+        return {"cell": 1.0, "cells": {}, "boxes": boxes, "large": []}
+    # حجم الخلية ≈ متوسط أبعاد الصناديق (الخيام متقاربة الحجم عادةً)
+    cell = sum((b[2] - b[0]) + (b[3] - b[1]) for b in valid) / (2.0 * len(valid))
+    cell = max(cell, 1e-6)
+    cells: Dict[Tuple[int, int], List[int]] = {}
+    large: List[int] = []   # غرف ضخمة تغطي خلايا كثيرة: تُفحص دائمًا بالصندوق فقط
+    for i, b in enumerate(boxes):
+        if not b:
+            continue
+        gx0, gx1 = int(b[0] // cell), int(b[2] // cell)
+        gy0, gy1 = int(b[1] // cell), int(b[3] // cell)
+        if (gx1 - gx0 + 1) * (gy1 - gy0 + 1) > GRID_MAX_CELLS_PER_ROOM:
+            large.append(i)
+            continue
+        for gx in range(gx0, gx1 + 1):
+            for gy in range(gy0, gy1 + 1):
+                cells.setdefault((gx, gy), []).append(i)
+    return {"cell": cell, "cells": cells, "boxes": boxes, "large": large}
+
+def grid_candidates(grid: Dict[str, Any], points) -> List[int]:
+    """أرقام الغرف المرشّحة لمجموعة نقاط (مرتبة وبدون تكرار)."""
+    cell, cells, boxes = grid["cell"], grid["cells"], grid["boxes"]
+    found = set()
+    for x, y in points:
+        for i in (*cells.get((int(x // cell), int(y // cell)), ()), *grid["large"]):
+            if i in found:
+                continue
+            b = boxes[i]
+            if b[0] <= x <= b[2] and b[1] <= y <= b[3]:
+                found.add(i)
+    return sorted(found)
+
+def match_doors_to_rooms(rooms: List[Dict[str, Any]], doors: List[Dict[str, Any]]) -> List[int]:
+    """
+    يرجع عدد الأبواب لكل غرفة (بنفس ترتيب rooms).
+    الباب يُحسب للغرفة إذا وقعت أي نقطة اختبار منه داخلها أو على حدها أو قربه،
+    لكن الاختبار الدقيق يتم فقط مع الغرف التي يقع الباب ضمن صناديقها.
+    """
+    counts = [0] * len(rooms)
+    if not rooms or not doors:
+        return counts
+    grid = build_room_grid(rooms, max(EPS, EDGE_EPS))
+    # الفهرس يعطي لكل غرفة الأبواب المرشّحة؛ ثم استدعاء واحد للنواة لكل غرفة
+    per_room: Dict[int, List[int]] = {}
+    for j, d in enumerate(doors):
+        for i in grid_candidates(grid, d["test_points"]):
+            per_room.setdefault(i, []).append(j)
+    for i, cand in per_room.items():
+        poly = rooms[i]["points"]
+        pts = [p for j in cand for p in doors[j]["test_points"]]
+        if len(pts) * (len(poly) - 1) < NP_KERNEL_MIN_WORK:
+            # عمل قليل (غرفة مستطيلة وباب أو اثنان): الحلقة العادية أسرع من تجهيز المصفوفات
+            counts[i] = sum(1 for j in cand
+                            if any(point_in_or_on_polygon_or_near(x, y, poly)
+                                   for (x, y) in doors[j]["test_points"]))
+            continue
+        owner = np.repeat(np.asarray(cand), [len(doors[j]["test_points"]) for j in cand])
+        mask = points_match_polygon_np(np.asarray(pts, dtype=np.float64).reshape(-1, 2),
+                                       polygon_array(poly))
+        counts[i] = len(np.unique(owner[mask]))
+    return counts
+
 def str_matches_any(s: str, keywords: List[str]) -> bool:
     ss = (s or "").upper()
     return any(k.upper() in ss for k in keywords)
@@ -184,28 +453,60 @@ def str_matches_any(s: str, keywords: List[str]) -> bool:
 def _layer_contains(s: str, needle: str) -> bool:
     return needle.lower() in (s or "").lower()
 
-def extract_rooms(doc) -> List[Dict[str, Any]]:
+def classify_modelspace(doc) -> Dict[str, Any]:
     """
-    يرجع الغرف من LWPOLYLINE المغلق بشرط أن اسم اللاير يحتوي "tent".
+    مرور واحد على modelspace يفرز الكيانات التي تحتاجها الفحوصات:
+    الغرف (لاير يحتوي "tent")، بوليلاينات حد المكتب، وبلوكات INSERT.
     """
-    msp = doc.modelspace()
-    rooms = []
-    for e in msp:
-        if e.dxftype() == "LWPOLYLINE" and is_closed_lwpolyline(e):
+    rooms: List[Dict[str, Any]] = []
+    site_polys: List[List[Tuple[float, float]]] = []
+    inserts = []
+    entities = 0
+    for e in doc.modelspace():
+        entities += 1
+        dxft = e.dxftype()
+        if dxft == "INSERT":
+            inserts.append(e)
+        elif dxft == "LWPOLYLINE" and is_closed_lwpolyline(e):
             layer = e.dxf.layer or ""
-            if not _layer_contains(layer, ROOM_LAYER_MUST_INCLUDE):
+            is_room = _layer_contains(layer, ROOM_LAYER_MUST_INCLUDE)
+            is_site = layer == SITE_BOUNDARY_LAYER
+            if not (is_room or is_site):
                 continue
             pts = lwpolyline_points(e)
-            rooms.append({
-                "entity": e,
-                "layer": layer,
-                "points": pts,
-                "area": polygon_area(pts)
-            })
-    return rooms
+            if is_room:
+                rooms.append({
+                    "entity": e,
+                    "layer": layer,
+                    "points": pts,
+                    "area": polygon_area(pts)
+                })
+            if is_site:
+                site_polys.append(pts)
+    return {"rooms": rooms, "site_polys": site_polys, "inserts": inserts, "entities": entities}
 
-def _collect_entity_points(ent) -> List[Tuple[float,float]]:
+def extract_rooms(doc) -> List[Dict[str, Any]]:
+    """
+    يرجع الغرف من LWPOLYLINE المغلق بشرط أن اسم اللاير يحتوي "tent".
+    """
+    return classify_modelspace(doc)["rooms"]
+
+def _xy_wcs(ent, p) -> Tuple[float, float]:
+    """يحوّل نقطة OCS (دوائر/أقواس/LWPOLYLINE) إلى WCS؛ البلوكات المعكوسة تنتج extrusion=(0,0,-1)."""
+    ext = ent.dxf.get("extrusion")
+    if ext is None or (abs(ext[0]) < 1e-12 and abs(ext[1]) < 1e-12 and ext[2] > 0):
+        return float(p[0]), float(p[1])
+    w = ent.ocs().to_wcs(Vec3(p[0], p[1], 0.0))
+    return float(w.x), float(w.y)
+
+def _entity_geometry(ent):
+    """
+    هندسة الكيان المستخدمة لحساب الصندوق (بإحداثيات WCS):
+    نقاط مباشرة، دوائر/أقواس (cx, cy, r)، وقطوع ناقصة (cx, cy, mx, my, ratio).
+    """
     pts: List[Tuple[float,float]] = []
+    circles: List[Tuple[float,float,float]] = []
+    ellipses: List[Tuple[float,float,float,float,float]] = []
     try:
         dxft = ent.dxftype()
         if dxft in ("LINE", "XLINE", "RAY"):
@@ -213,48 +514,109 @@ def _collect_entity_points(ent) -> List[Tuple[float,float]]:
             pts += [(float(s.x), float(s.y)), (float(e.x), float(e.y))]
         elif dxft == "LWPOLYLINE":
             for x, y, *_ in ent.get_points():
-                pts.append((float(x), float(y)))
+                pts.append(_xy_wcs(ent, (x, y)))
         elif dxft == "POLYLINE":
             for v in ent.vertices:
                 p = v.dxf.location
                 pts.append((float(p.x), float(p.y)))
         elif dxft in ("CIRCLE", "ARC"):
-            c = ent.dxf.center; r = float(ent.dxf.radius)
-            pts += [
-                (float(c.x + r), float(c.y)),
-                (float(c.x - r), float(c.y)),
-                (float(c.x), float(c.y + r)),
-                (float(c.x), float(c.y - r)),
-            ]
+            cx, cy = _xy_wcs(ent, ent.dxf.center)
+            circles.append((cx, cy, float(ent.dxf.radius)))
         elif dxft == "ELLIPSE":
             c = ent.dxf.center
-            mx, my = ent.dxf.major_axis.x, ent.dxf.major_axis.y
-            pts += [(float(c.x + mx), float(c.y + my)), (float(c.x - mx), float(c.y - my))]
+            ellipses.append((float(c.x), float(c.y),
+                             float(ent.dxf.major_axis.x), float(ent.dxf.major_axis.y),
+                             float(ent.dxf.ratio)))
         elif dxft == "POINT":
             p = ent.dxf.location
             pts.append((float(p.x), float(p.y)))
     except Exception:
         pass
-    return pts
+    return pts, circles, ellipses
+
+def _geometry_points(pts, circles, ellipses) -> List[Tuple[float,float]]:
+    out = list(pts)
+    for cx, cy, r in circles:
+        out += [(cx + r, cy), (cx - r, cy), (cx, cy + r), (cx, cy - r)]
+    for cx, cy, mx, my, _ in ellipses:
+        out += [(cx + mx, cy + my), (cx - mx, cy - my)]
+    return out
 
-def insert_test_points(ins) -> List[Tuple[float,float]]:
-    pts: List[Tuple[float,float]] = []
-    try:
-        ip = ins.dxf.insert
-        pts.append((float(ip.x), float(ip.y)))
-        xs, ys = [], []
-        for part in ins.virtual_entities():
-            for (x, y) in _collect_entity_points(part):
-                xs.append(x); ys.append(y)
-        if xs and ys:
-            xmin, xmax = min(xs), max(xs)
-            ymin, ymax = min(ys), max(ys)
-            cx, cy = (xmin + xmax)/2.0, (ymin + ymax)/2.0
-            pts.extend([
-                (cx, cy), (xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax)
-            ])
-    except Exception:
-        pass
+def _collect_entity_points(ent) -> List[Tuple[float,float]]:
+    return _geometry_points(*_entity_geometry(ent))
+
+def block_local_geometry(doc, name: str, block_cache: Dict[str, Any]):
+    """
+    هندسة تعريف البلوك بإحداثياته المحلية، تُحسب مرة واحدة لكل اسم بلوك.
+    ترجع None إذا لم يوجد التعريف.
+    """
+    if name in block_cache:
+        return block_cache[name]
+    geom = None
+    blk = doc.blocks.get(name) if doc is not None else None
+    if blk is not None:
+        pts, circles, ellipses = [], [], []
+        for ent in blk:
+            p, c, e = _entity_geometry(ent)
+            pts += p; circles += c; ellipses += e
+        geom = {
+            "base": Vec3(blk.base_point),
+            "points": [Vec3(x, y, 0.0) for x, y in pts],
+            "circles": circles,
+            "ellipses": ellipses,
+        }
+    block_cache[name] = geom
+    return geom
+
+def _virtual_insert_points(ins) -> List[Tuple[float,float]]:
+    """المسار المرجعي: تفجير البلوك بـ virtual_entities وجمع نقاطه."""
+    out: List[Tuple[float,float]] = []
+    for part in ins.virtual_entities():
+        out += _collect_entity_points(part)
+    return out
+
+def _transform_geometry(m, geom) -> List[Tuple[float,float]]:
+    """
+    يحوّل هندسة البلوك المخزّنة بمصفوفة (إدراج واحد أو تركيب إدراجات متداخلة).
+    الدوائر تبقى دوائر تحت التحويل المتشابه، وتصبح قطوعًا ناقصة تحت المقياس غير المتساوي
+    كما يفعل virtual_entities.
+    """
+    pts = [(float(v.x), float(v.y)) for v in m.transform_vertices(geom["points"])]
+    ux, uy = m.ux, m.uy
+    sx, sy = math.hypot(ux.x, ux.y), math.hypot(uy.x, uy.y)
+    conformal = (abs(sx - sy) <= 1e-9 * max(sx, sy, 1.0)
+                 and abs(ux.x * uy.x + ux.y * uy.y) <= 1e-9 * max(sx * sy, 1.0))
+    circles, ellipses = [], []
+    for cx, cy, r in geom["circles"]:
+        if conformal:
+            c = m.transform(Vec3(cx, cy, 0.0))
+            circles.append((float(c.x), float(c.y), r * sx))
+        else:
+            ce = ConstructionEllipse(center=(cx, cy, 0.0), major_axis=(r, 0.0, 0.0), ratio=1.0)
+            ce.transform(m)
+            ellipses.append((ce.center.x, ce.center.y, ce.major_axis.x, ce.major_axis.y, ce.ratio))
+    for cx, cy, mx, my, ratio in geom["ellipses"]:
+        if conformal:
+            c = m.transform(Vec3(cx, cy, 0.0))
+            a = m.transform_direction(Vec3(mx, my, 0.0))
+            ellipses.append((float(c.x), float(c.y), float(a.x), float(a.y), ratio))
+        else:
+            ce = ConstructionEllipse(center=(cx, cy, 0.0), major_axis=(mx, my, 0.0), ratio=ratio)
+            ce.transform(m)
+            ellipses.append((ce.center.x, ce.center.y, ce.major_axis.x, ce.major_axis.y, ce.ratio))
+    return _geometry_points(pts, circles, ellipses)
+
+def _test_points_from(insert_xy: Tuple[float,float], world) -> List[Tuple[float,float]]:
+    """نقطة الإدراج + مركز وزوايا صندوق النقاط world، بدون تكرار."""
+    pts: List[Tuple[float,float]] = [insert_xy]
+    if world:
+        xs = [p[0] for p in world]; ys = [p[1] for p in world]
+        xmin, xmax = min(xs), max(xs)
+        ymin, ymax = min(ys), max(ys)
+        cx, cy = (xmin + xmax)/2.0, (ymin + ymax)/2.0
+        pts.extend([
+            (cx, cy), (xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax)
+        ])
     # إزالة التكرار مع تقريب
     out, seen = [], set()
     for x, y in pts:
@@ -263,35 +625,127 @@ def insert_test_points(ins) -> List[Tuple[float,float]]:
             seen.add(k); out.append((x,y))
     return out
 
-def collect_inserts_robust(doc, max_depth: int = 2) -> List[Dict[str, Any]]:
-    msp = doc.modelspace()
-    results: List[Dict[str, Any]] = []
-    def push(ins):
-        rec = {
-            "name": ins.dxf.name or "",
-            "layer": ins.dxf.layer,
-            "test_points": insert_test_points(ins)
-        }
-        if not rec["test_points"]:
-            ip = ins.dxf.insert
-            rec["test_points"] = [(float(ip.x), float(ip.y))]
-        results.append(rec)
+def insert_test_points(ins, block_cache: Optional[Dict[str, Any]] = None, doc=None) -> List[Tuple[float,float]]:
+    """
+    نقاط اختبار البلوك: نقطة الإدراج + مركز وزوايا صندوقه.
+    هندسة كل تعريف بلوك تُحسب مرة واحدة (block_cache) ثم تُحوّل لكل إدراج.
+    """
+    if block_cache is None:
+        block_cache = {}
+    if doc is None:
+        doc = ins.doc
+    try:
+        insert_xy = _xy_wcs(ins, ins.dxf.insert)
+    except Exception:
+        return []
+    world: List[Tuple[float,float]] = []
+    try:
+        geom = block_local_geometry(doc, ins.dxf.name, block_cache)
+        if geom is not None and ins.mcount <= 1:
+            world = _transform_geometry(ins.matrix44(), geom)
+        else:
+            world = _virtual_insert_points(ins)
+    except Exception:
+        pass
+    return _test_points_from(insert_xy, world)
+
+def nested_test_points(doc, name: str, m, block_cache: Dict[str, Any]) -> List[Tuple[float,float]]:
+    """نقاط اختبار إدراج متداخل معرّف بمصفوفته الكاملة m (بلوك → WCS)."""
+    geom = block_local_geometry(doc, name, block_cache)
+    if geom is None:
+        o = m.transform(Vec3())
+        return [(float(o.x), float(o.y))]
+    o = m.transform(geom["base"])
+    return _test_points_from((float(o.x), float(o.y)), _transform_geometry(m, geom))
+
+def is_door_insert(name: str, layer: str) -> bool:
+    return str_matches_any(name, DOOR_KEYWORDS) or str_matches_any(layer, DOOR_LAYER_KEYWORDS)
+
+def _is_counted_insert(name: str, layer: str) -> bool:
+    """الإدراجات التي تهم الفحص: أبواب، مداخل فرعية، مداخل رئيسية."""
+    return is_door_insert(name, layer) or layer in (EXIT_LAYER, ENTER_LAYER)
+
+def _block_children(doc, name: str, graph: Dict[str, Any]) -> List[Tuple[str, str, Any]]:
+    """حافة في شبكة مراجع البلوكات: الإدراجات المباشرة داخل تعريف البلوك ومصفوفاتها."""
+    if name in graph:
+        return graph[name]
+    refs = []
+    blk = doc.blocks.get(name)
+    if blk is not None:
+        for e in blk.query("INSERT"):
+            try:
+                refs.append((e.dxf.name or "", e.dxf.layer or "", e.matrix44()))
+            except Exception:
+                pass
+    graph[name] = refs
+    return refs
+
+def nested_counted_inserts(doc, name: str, memo: Dict[str, Any], graph: Dict[str, Any],
+                           _stack: Optional[set] = None) -> List[Tuple[str, str, Any]]:
+    """
+    كل الإدراجات المتداخلة المهمة (باب/مخرج/مدخل) داخل البلوك name بأي عمق،
+    مع مصفوفة تحويلها إلى إحداثيات البلوك name. تُحسب مرة واحدة لكل تعريف بلوك.
+    """
+    if name in memo:
+        return memo[name]
+    stack = _stack if _stack is not None else set()
+    if name in stack:  # مرجع دائري (ملف تالف)
+        return []
+    stack.add(name)
+    out: List[Tuple[str, str, Any]] = []
+    for child, layer, m in _block_children(doc, name, graph):
+        if _is_counted_insert(child, layer):
+            out.append((child, layer, m))
+        for gname, glayer, gm in nested_counted_inserts(doc, child, memo, graph, stack):
+            out.append((gname, glayer, gm @ m))
+    stack.discard(name)
+    memo[name] = out
+    return out
 
-    for e in msp.query("INSERT"):
-        push(e)
+def insert_records(doc, ins, caches: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    سجل للإدراج نفسه + سجلات الأبواب/المداخل المتداخلة داخله بأي عمق.
+    المتداخلة تُحل من شبكة مراجع البلوكات (مرة لكل تعريف) بتركيب مصفوفة واحد لكل نسخة.
+    """
+    block_cache, graph, memo = caches["blocks"], caches["graph"], caches["memo"]
+    rec = {
+        "name": ins.dxf.name or "",
+        "layer": ins.dxf.layer,
+        "test_points": insert_test_points(ins, block_cache, doc)
+    }
+    if not rec["test_points"]:
+        ip = ins.dxf.insert
+        rec["test_points"] = [(float(ip.x), float(ip.y))]
+    out = [rec]
 
-    def walk(entity, depth: int):
-        if depth <= 0: return
-        try:
-            for part in entity.virtual_entities():
-                if part.dxftype() == "INSERT":
-                    push(part)
-                    walk(part, depth-1)
-        except Exception:
-            pass
+    nested = nested_counted_inserts(doc, rec["name"], memo, graph)
+    if not nested:
+        return out
+    try:
+        cells = list(ins.multi_insert()) if ins.mcount > 1 else [ins]
+        for cell in cells:
+            top_m = cell.matrix44()
+            for name, layer, rel in nested:
+                out.append({
+                    "name": name,
+                    "layer": layer,
+                    "test_points": nested_test_points(doc, name, rel @ top_m, block_cache),
+                })
+    except Exception:
+        pass
+    return out
 
-    for e in msp.query("INSERT"):
-        walk(e, max_depth)
+def new_insert_caches() -> Dict[str, Any]:
+    return {"blocks": {}, "graph": {}, "memo": {}}
+
+def collect_inserts_robust(doc, top_inserts=None) -> List[Dict[str, Any]]:
+    """كل إدراجات modelspace + الأبواب/المداخل المتداخلة داخلها."""
+    if top_inserts is None:
+        top_inserts = doc.modelspace().query("INSERT")
+    results: List[Dict[str, Any]] = []
+    caches = new_insert_caches()
+    for ins in top_inserts:
+        results += insert_records(doc, ins, caches)
     return results
 
 def sum_closed_polyline_area_in_layer(doc, layer_name: str) -> Tuple[float, int]:
@@ -310,35 +764,49 @@ def sum_closed_polyline_area_in_layer(doc, layer_name: str) -> Tuple[float, int]
 def count_inserts_in_layer(inserts: List[Dict[str,Any]], layer_name: str) -> int:
     return sum(1 for b in inserts if (b.get("layer") or "") == layer_name)
 
-def check_dxf(path: str) -> Dict[str, Any]:
-    doc = ezdxf.readfile(path)
+def check_dxf(path: str, doc=None, timings: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """يفحص ملف DXF؛ يمكن تمرير doc مقروء مسبقًا لتجنّب قراءة الملف مرة ثانية."""
+    timings = {} if timings is None else timings
+    if doc is None:
+        with timed(timings, "parse"):
+            doc = ezdxf.readfile(path)
 
-    # الغرف: بوليلين مغلق في لاير يحتوي "tent"
-    rooms   = extract_rooms(doc)
-    inserts = collect_inserts_robust(doc, max_depth=2)
+    # مرور واحد على modelspace
+    with timed(timings, "extract_rooms"):
+        groups = classify_modelspace(doc)
 
+    # الغرف: بوليلين مغلق في لاير يحتوي "tent"
+    with timed(timings, "collect_inserts"):
+        inserts = collect_inserts_robust(doc, top_inserts=groups["inserts"])
+    result = evaluate_rooms(groups["rooms"], groups["site_polys"], inserts, timings)
+    result["counts"]["entities"] = groups["entities"]
+    result["check_mode"] = "full"
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["timings"] = timings
+    return result
+
+def evaluate_rooms(rooms: List[Dict[str, Any]], site_polys, inserts: List[Dict[str, Any]],
+                   timings: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """قواعد الفحص على الغرف والإدراجات المستخرجة (مشتركة بين الوضع الكامل والمتدفق)."""
     # أبواب فقط
-    doors = [b for b in inserts if str_matches_any(b["name"], DOOR_KEYWORDS) or
-                                   str_matches_any(b["layer"], DOOR_LAYER_KEYWORDS)]
+    doors = [b for b in inserts if is_door_insert(b["name"], b["layer"])]
 
     # معلومات الموقع (حد المكتب + عداد المداخل)
-    site_area_m2, site_poly_count = sum_closed_polyline_area_in_layer(doc, SITE_BOUNDARY_LAYER)
+    site_area_m2 = sum(polygon_area(pts) for pts in site_polys)
+    site_poly_count = len(site_polys)
     exits_count  = count_inserts_in_layer(inserts, EXIT_LAYER)
     enters_count = count_inserts_in_layer(inserts, ENTER_LAYER)
 
+    # عدد الأبواب لكل غرفة عبر الفهرس المكاني
+    with timed(timings, "match_doors"):
+        door_counts = match_doors_to_rooms(rooms, doors)
+
     results, failed = [], 0
 
     for idx, room in enumerate(rooms, start=1):
-        pts, area = room["points"], room["area"]
-
-        def inside_room(block) -> bool:
-            for (x, y) in block["test_points"]:
-                if point_in_or_on_polygon_or_near(x, y, pts):
-                    return True
-            return False
-
-        room_doors = [d for d in doors if inside_room(d)]
-        has_door = len(room_doors) > 0
+        area = room["area"]
+        doors_count = door_counts[idx - 1]
+        has_door = doors_count > 0
         area_ok  = area >= MIN_AREA
         ok = has_door and area_ok
         if not ok: failed += 1
@@ -351,7 +819,7 @@ def check_dxf(path: str) -> Dict[str, Any]:
             "room_index": idx,
             "layer": room["layer"],
             "area_m2": round(area, 3),
-            "doors_count": len(room_doors),
+            "doors_count": doors_count,
             "windows_count": 0,  # للتوافق مع واجهات قديمة
             "passed": ok,
             "notes": "صحيحة: تحتوي DOOR ومساحتها كافية" if ok else "، ".join(msgs),
@@ -373,11 +841,306 @@ def check_dxf(path: str) -> Dict[str, Any]:
             "enters_layer": ENTER_LAYER,
             "enters_count": enters_count,
         },
+        "counts": {"rooms": len(rooms), "inserts": len(inserts), "doors": len(doors)},
         "rooms": results,
     }
 
+def peak_rss_mb() -> Optional[float]:
+    """أعلى استهلاك ذاكرة للعملية حتى الآن (MB)؛ None على ويندوز."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss بالكيلوبايت على لينكس وبالبايت على macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+# ================== الفحص المتدفق للملفات الضخمة ==================
+# الوضع الكامل يحمّل المستند كله (HATCH/TEXT/DIMENSION...) في الذاكرة.
+# هذا الوضع يقرأ قسم BLOCKS (هندسة البلوكات فقط) ثم يمرّ على كيانات modelspace
+# واحدًا واحدًا عبر iterdxf، ويحتفظ فقط بنقاط الغرف وسجلات الإدراجات.
+STREAM_CHECK_MB: int = int(os.environ.get("STREAM_CHECK_MB", "150"))
+
+_BLOCK_TYPES = {"BLOCK", "ENDBLK", "INSERT", "ATTRIB", "SEQEND", "LINE", "XLINE", "RAY",
+                "LWPOLYLINE", "POLYLINE", "VERTEX", "CIRCLE", "ARC", "ELLIPSE", "POINT"}
+
+class _StreamedBlock:
+    """بديل خفيف لـ BlockLayout: اسم + نقطة أساس + الكيانات الهندسية فقط."""
+    def __init__(self, name: str, base_point):
+        self.name = name
+        self.base_point = Vec3(base_point)
+        self.entities: list = []
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def query(self, dxftype: str):
+        return [e for e in self.entities if e.dxftype() == dxftype]
+
+class _StreamedDoc:
+    """يكفي لما تحتاجه دوال البلوكات: doc.blocks.get(name)."""
+    def __init__(self):
+        self.blocks: Dict[str, _StreamedBlock] = {}
+
+def _load_streamed_blocks(it) -> _StreamedDoc:
+    sdoc = _StreamedDoc()
+    if "BLOCKS" not in it.sections:
+        return sdoc
+    linked = entity_linker()
+    current: Optional[_StreamedBlock] = None
+    for e in it.load_entities(it.sections["BLOCKS"] + 1, _BLOCK_TYPES):
+        dxft = e.dxftype()
+        if dxft == "BLOCK":
+            name = e.dxf.name or ""
+            # بلوكات الـ layouts ليست تعريفات قابلة للإدراج
+            if name.lower().startswith(("*model_space", "*paper_space")):
+                current = None
+            else:
+                current = sdoc.blocks[name] = _StreamedBlock(name, e.dxf.base_point)
+        elif dxft == "ENDBLK":
+            current = None
+        elif current is not None and not linked(e):
+            current.entities.append(e)
+    return sdoc
+
+def stream_check_dxf(path: str, timings: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """نفس نتيجة check_dxf لكن بذاكرة محدودة (لا يُحمَّل المستند كاملًا)."""
+    timings = {} if timings is None else timings
+    with timed(timings, "parse"):
+        it = iterdxf.opendxf(path)
+    try:
+        with timed(timings, "parse"):
+            sdoc = _load_streamed_blocks(it)
+        rooms: List[Dict[str, Any]] = []
+        site_polys: List[List[Tuple[float, float]]] = []
+        inserts: List[Dict[str, Any]] = []
+        caches = new_insert_caches()
+        entities = 0
+        # القراءة والاستخراج متداخلان في هذا الوضع فيُحسبان مرحلة واحدة
+        t0 = time.perf_counter()
+        for e in it.modelspace(types=["LWPOLYLINE", "INSERT"]):
+            entities += 1
+            if e.dxftype() == "INSERT":
+                inserts += insert_records(sdoc, e, caches)
+            elif is_closed_lwpolyline(e):
+                layer = e.dxf.layer or ""
+                is_room = _layer_contains(layer, ROOM_LAYER_MUST_INCLUDE)
+                is_site = layer == SITE_BOUNDARY_LAYER
+                if not (is_room or is_site):
+                    continue
+                pts = lwpolyline_points(e)
+                if is_room:
+                    rooms.append({"layer": layer, "points": pts, "area": polygon_area(pts)})
+                if is_site:
+                    site_polys.append(pts)
+        timings["stream_extract"] = round(time.perf_counter() - t0, 4)
+    finally:
+        it.close()
+    result = evaluate_rooms(rooms, site_polys, inserts, timings)
+    result["counts"]["entities"] = entities
+    result["check_mode"] = "stream"
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["timings"] = timings
+    return result
+
+def use_stream_mode(path) -> bool:
+    try:
+        return Path(path).stat().st_size > STREAM_CHECK_MB * 1024 * 1024
+    except OSError:
+        return False
+
+# ================== المهام: الفحص والمعاينة في مجمّع عمليات ==================
+# الفحص ثقيل على المعالج، فيُنفَّذ خارج حلقة الأحداث حتى لا يحجب باقي الطلبات.
+# حالة المهمة تُكتب في ملف RESULTS/<token>.job.json لتُقرأ من أي عامل uvicorn.
+CHECK_WORKERS: int = int(os.environ.get("CHECK_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+
+_job_pool: Optional[ProcessPoolExecutor] = None
+
+def get_job_pool() -> ProcessPoolExecutor:
+    global _job_pool
+    if _job_pool is None:
+        # spawn بدل fork: الخادم فيه خيوط (التحميل المسبق، threadpool) و fork معها قد يعلّق العامل
+        _job_pool = ProcessPoolExecutor(max_workers=CHECK_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+    return _job_pool
+
+def shutdown_job_pool():
+    global _job_pool
+    if _job_pool is not None:
+        _job_pool.shutdown(wait=False, cancel_futures=True)
+        _job_pool = None
+
+def job_status_path(token: str) -> Path:
+    return RESULTS / f"{token}.job.json"
+
+def set_job_status(token: str, state: str, stage: str = "", progress: float = 0.0, error: str = ""):
+    safe_json_dump(job_status_path(token), {
+        "token": token,
+        "state": state,          # queued | running | done | error
+        "stage": stage,
+        "progress": round(progress, 2),
+        "error": error,
+    })
+
+def get_job_status(token: str) -> Optional[dict]:
+    if (RESULTS / f"{token}.json").exists():
+        return {"token": token, "state": "done", "stage": "done", "progress": 1.0, "error": ""}
+    p = job_status_path(token)
+    if not p.exists():
+        return None
+    try:
+        return safe_json_load(p)
+    except Exception:
+        return None
+
+def run_check_job(token: str, dxf_path: str, sha256: str = "",
+                  timings: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    يُنفَّذ داخل عملية من المجمّع: قراءة + فحص + معاينة + حفظ النتيجة.
+    يرجع ملخصًا (الحالة، التوقيتات، الأعداد) تسجّله العملية الرئيسية في /metrics.
+    """
+    timings = dict(timings or {})
+    summary: Dict[str, Any] = {"token": token, "state": "error", "mode": "", "timings": timings, "counts": {}}
+    try:
+        if use_stream_mode(dxf_path):
+            # ملف ضخم: فحص متدفق بذاكرة محدودة، والمعاينة الكاملة تتطلب المستند كله فتُتخطّى
+            set_job_status(token, "running", "check", 0.1)
+            result = stream_check_dxf(dxf_path, timings)
+            ok, err = False, f"تم تخطي المعاينة: الملف أكبر من {STREAM_CHECK_MB} MB"
+        else:
+            set_job_status(token, "running", "parse", 0.05)
+            with timed(timings, "parse"):
+                doc = ezdxf.readfile(dxf_path)
+
+            set_job_status(token, "running", "check", 0.3)
+            result = check_dxf(dxf_path, doc=doc, timings=timings)
+
+            set_job_status(token, "running", "preview", 0.6)
+            with timed(timings, "preview"):
+                ok, err = generate_preview(Path(dxf_path), RESULTS / f"{token}.png", doc=doc)
+
+        set_job_status(token, "running", "save", 0.95)
+        with timed(timings, "json_dump"):
+            safe_json_dump(RESULTS / f"{token}.json", {
+                "token": token,
+                "source_dxf": dxf_path,
+                "source_sha256": sha256,
+                "result": result,
+                "preview_ext": "png" if ok else "",
+                "preview_error": "" if ok else err,
+            })
+        set_job_status(token, "done", "done", 1.0)
+        summary.update(state="done", mode=result.get("check_mode", ""), counts=result.get("counts", {}))
+    except Exception as e:
+        set_job_status(token, "error", "", 0.0, f"{type(e).__name__}: {e}")
+    return summary
+
+def _record_job_metrics(future):
+    try:
+        summary = future.result()
+    except Exception:
+        inc_counter("dxf_checker_checks_total", status="crashed", mode="")
+        return
+    inc_counter("dxf_checker_checks_total", status=summary["state"], mode=summary["mode"])
+    observe_timings(summary["timings"])
+    for kind, n in summary["counts"].items():
+        observe("dxf_checker_check_size", n, buckets=COUNT_BUCKETS, kind=kind)
+        inc_counter(f"dxf_checker_{kind}_total", n)
+
+def submit_check_job(token: str, dxf_path: Path, sha256: str = "",
+                     timings: Optional[Dict[str, float]] = None):
+    set_job_status(token, "queued", "queued", 0.0)
+    fut = get_job_pool().submit(run_check_job, token, str(dxf_path), sha256, timings)
+    fut.add_done_callback(_record_job_metrics)
+
+# ================== كاش النتائج حسب المحتوى ==================
+# التوكن = بصمة (محتوى DXF + إعدادات القواعد)، فإعادة رفع نفس الملف بنفس القواعد
+# ترجع النتيجة والمعاينة المخزنة فورًا بدل إعادة الفحص والرسم.
+CHECKER_VERSION: int = 1   # غيّره عند تعديل منطق الفحص لإبطال النتائج المخزنة
+
+RESULTS_MAX_MB: int = int(os.environ.get("RESULTS_MAX_MB", "1024"))
+UPLOADS_MAX_MB: int = int(os.environ.get("UPLOADS_MAX_MB", "4096"))
+
+# عدادات لكل عملية (كل عامل uvicorn له عداداته)
+CACHE_STATS: Dict[str, int] = {"hits": 0, "misses": 0, "evicted": 0}
+
+def rules_fingerprint() -> str:
+    rules = {
+        "version": CHECKER_VERSION,
+        "min_area": MIN_AREA,
+        "room_layer": ROOM_LAYER_MUST_INCLUDE,
+        "site_layer": SITE_BOUNDARY_LAYER,
+        "exit_layer": EXIT_LAYER,
+        "enter_layer": ENTER_LAYER,
+        "door_keywords": DOOR_KEYWORDS,
+        "door_layer_keywords": DOOR_LAYER_KEYWORDS,
+        "eps": EPS,
+        "edge_eps": EDGE_EPS,
+    }
+    return hashlib.sha256(json.dumps(rules, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def cache_token(dxf_sha256: str) -> str:
+    return hashlib.sha256(f"{dxf_sha256}:{rules_fingerprint()}".encode("ascii")).hexdigest()[:32]
+
+def touch_token(token: str):
+    """يحدّث وقت آخر استخدام للنتيجة (ترتيب LRU)."""
+    try:
+        os.utime(RESULTS / f"{token}.json")
+    except OSError:
+        pass
+
+def _token_groups(directory: Path) -> Dict[str, List[Tuple[Path, int, float]]]:
+    """يجمع ملفات المجلد حسب التوكن (الجزء قبل أول نقطة)."""
+    groups: Dict[str, List[Tuple[Path, int, float]]] = {}
+    for p in directory.iterdir():
+        if not p.is_file() or p.name.endswith((".part", ".tmp", ".upload")):
+            continue
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        groups.setdefault(p.name.split(".", 1)[0], []).append((p, st.st_size, st.st_mtime))
+    return groups
+
+def evict_lru(directory: Path, max_bytes: int, keep: set) -> int:
+    """يحذف أقدم التوكنات استخدامًا حتى يصبح حجم المجلد ضمن max_bytes."""
+    groups = _token_groups(directory)
+    total = sum(sz for files in groups.values() for _, sz, _ in files)
+    if total <= max_bytes:
+        return 0
+    order = sorted(groups.items(), key=lambda kv: max(mt for _, _, mt in kv[1]))
+    evicted = 0
+    for token, files in order:
+        if total <= max_bytes:
+            break
+        if token in keep:
+            continue
+        for p, sz, _ in files:
+            try:
+                p.unlink()
+                total -= sz
+            except OSError:
+                pass
+        evicted += 1
+    return evicted
+
+def enforce_storage_limits():
+    active = set()
+    for p in RESULTS.glob("*.job.json"):
+        token = p.name.split(".", 1)[0]
+        st = get_job_status(token)
+        if st and st.get("state") in ("queued", "running"):
+            active.add(token)
+    n = evict_lru(RESULTS, RESULTS_MAX_MB * 1024 * 1024, active)
+    n += evict_lru(UPLOADS, UPLOADS_MAX_MB * 1024 * 1024, active)
+    CACHE_STATS["evicted"] += n
+
+def dir_size(directory: Path) -> int:
+    return sum(sz for files in _token_groups(directory).values() for _, sz, _ in files)
+
 # ================== واجهة HTML (بدون Jinja) ==================
-def render_index(token: str, data: Optional[dict], preview_url: Optional[str]) -> str:
+def render_index(token: str, data: Optional[dict], preview_url: Optional[str],
+                 job: Optional[dict] = None) -> str:
     summary = summarize(data["result"]) if data else {"failed":0,"passed":0,"rooms":0}
     site = (data or {}).get("result", {}).get("site_info") if data else None
 
@@ -409,6 +1172,26 @@ def render_index(token: str, data: Optional[dict], preview_url: Optional[str]) -
         </table>
     """ if rows_html else '<p class="hint">لا توجد نتائج بعد. ارفعي ملف CAD لبدء الفحص.</p>'
 
+    # مهمة قيد التنفيذ: الصفحة تسأل /jobs/{token} حتى تجهز النتيجة ثم تعيد التحميل
+    if not data and job:
+        if job.get("state") == "error":
+            table_or_hint = f'<p class="status-fail">فشل الفحص: {esc(job.get("error"))}</p>'
+        else:
+            table_or_hint = f"""
+        <p class="hint" id="job-status">جارٍ الفحص… ({esc(job.get('stage'))})</p>
+        <script>
+          (function poll(){{
+            fetch("/jobs/{esc(token)}").then(r => r.json()).then(j => {{
+              if (j.state === "done") {{ location.reload(); return; }}
+              const el = document.getElementById("job-status");
+              if (j.state === "error") {{ el.className = "status-fail"; el.textContent = "فشل الفحص: " + j.error; return; }}
+              el.textContent = "جارٍ الفحص… (" + j.stage + " " + Math.round(j.progress * 100) + "%)";
+              setTimeout(poll, 1500);
+            }}).catch(() => setTimeout(poll, 3000));
+          }})();
+        </script>
+            """
+
     # بطاقة ملخص الموقع
     site_html = """
       <p class="hint" style="margin:0">لا توجد بيانات بعد. ارفعي ملف CAD لعرض الملخص.</p>
@@ -427,7 +1210,7 @@ def render_index(token: str, data: Optional[dict], preview_url: Optional[str]) -
     export_html = f"""
       <a class="btn" href="/export-pdf?token={esc(token)}">تصدير PDF</a>
       <a class="btn" href="/export-excel?token={esc(token)}">تصدير Excel</a>
-    """ if token else '<span class="hint">سيظهر التصدير بعد رفع الملف.</span>'
+    """ if token and data else '<span class="hint">سيظهر التصدير بعد رفع الملف.</span>'
 
     return f"""<!DOCTYPE html>
 <html lang="ar" dir="rtl">
@@ -547,49 +1330,97 @@ def render_index(token: str, data: Optional[dict], preview_url: Optional[str]) -
 async def index(request: Request, token: Optional[str] = None):
     data = None
     preview_url = None
+    job = None
     if token:
         p = RESULTS / f"{token}.json"
         if p.exists():
             data = safe_json_load(p)
+            touch_token(token)
             if data.get("preview_ext") == "png":
                 preview_url = f"/results/{token}.png"
-    return HTMLResponse(render_index(token or "", data, preview_url))
+        else:
+            job = get_job_status(token)
+    return HTMLResponse(render_index(token or "", data, preview_url, job))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    text = render_metrics()
+    text += "# TYPE dxf_checker_startup_seconds gauge\n"
+    for phase, v in STARTUP.items():
+        if v is not None:
+            text += f'dxf_checker_startup_seconds{{phase="{phase[:-2]}"}} {v}\n'
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {
+        **CACHE_STATS,
+        "results_bytes": dir_size(RESULTS),
+        "uploads_bytes": dir_size(UPLOADS),
+        "results_max_mb": RESULTS_MAX_MB,
+        "uploads_max_mb": UPLOADS_MAX_MB,
+    }
+
+@app.get("/jobs/{token}")
+def job_status(token: str):
+    status = get_job_status(token)
+    if status is None:
+        return JSONResponse({"token": token, "state": "unknown"}, status_code=404)
+    return status
 
 @app.post("/upload-cad")
 async def upload_cad(request: Request, cad_file: UploadFile, excel_file: UploadFile | None = None):
-    # حفظ DXF
-    token = uuid.uuid4().hex
+    # حفظ DXF على قطع (الذاكرة ثابتة مهما كان حجم الملف)
+    timings: Dict[str, float] = {}
+    tmp_path = UPLOADS / f"{uuid.uuid4().hex}.upload"
+    with timed(timings, "upload"):
+        saved = await save_upload_stream(cad_file, tmp_path)
+    observe_timings(timings)
+    if saved is None:
+        return HTMLResponse(f"الملف أكبر من الحد المسموح ({MAX_UPLOAD_MB} MB).", status_code=413)
+    _, sha256 = saved
+
+    # نفس الملف ونفس القواعد ← نفس التوكن: نتيجة جاهزة أو مهمة جارية
+    token = cache_token(sha256)
+    status = get_job_status(token)
+    if status and status.get("state") in ("done", "queued", "running"):
+        tmp_path.unlink(missing_ok=True)
+        CACHE_STATS["hits"] += 1
+        inc_counter("dxf_checker_cache_requests_total", result="hit")
+        touch_token(token)
+        return RedirectResponse(url=f"/?token={token}", status_code=303)
+    CACHE_STATS["misses"] += 1
+    inc_counter("dxf_checker_cache_requests_total", result="miss")
     dxf_path = UPLOADS / f"{token}.dxf"
-    dxf_bytes = await cad_file.read()
-    dxf_path.write_bytes(dxf_bytes)
-
-    # فحص
-    result = check_dxf(str(dxf_path))
-
-    # توليد المعاينة
-    preview_path = RESULTS / f"{token}.png"
-    ok, err = generate_preview(dxf_path, preview_path)
+    os.replace(tmp_path, dxf_path)
 
-    data_to_store = {
-        "token": token,
-        "source_dxf": str(dxf_path),
-        "result": result,
-        "preview_ext": "png" if ok else "",
-        "preview_error": "" if ok else err,
-    }
-    safe_json_dump(RESULTS / f"{token}.json", data_to_store)
+    # الفحص + المعاينة في مجمّع العمليات؛ الرد يرجع فورًا بالتوكن
+    submit_check_job(token, dxf_path, sha256, timings)
+    enforce_storage_limits()
 
-    # رجوع للواجهة الرئيسية مع التوكن
+    # رجوع للواجهة الرئيسية مع التوكن (تتابع حالة المهمة)
     return RedirectResponse(url=f"/?token={token}", status_code=303)
 
+def _timed_file_response(path: Path, timings: Dict[str, float], **kw) -> FileResponse:
+    observe_timings(timings)
+    server_timing = ", ".join(f"{k};dur={v * 1000:.1f}" for k, v in timings.items())
+    return FileResponse(str(path), headers={"Server-Timing": server_timing}, **kw)
+
 @app.get("/export-excel")
 def export_excel(token: str):
     p = RESULTS / f"{token}.json"
     if not p.exists():
         return HTMLResponse("Token not found.", status_code=404)
-    data = safe_json_load(p)
-    result = data["result"]
-
+    timings: Dict[str, float] = {}
+    with timed(timings, "export_load"):
+        data = safe_json_load(p)
+    with timed(timings, "export_excel"):
+        out_xlsx = _build_excel(token, data["result"])
+    return _timed_file_response(out_xlsx, timings, filename=f"DXF_Check_{token}.xlsx",
+                                media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+def _build_excel(token: str, result: dict) -> Path:
+    from openpyxl import Workbook
     wb = Workbook()
     ws = wb.active
     ws.title = "DXF Check"
@@ -606,17 +1437,25 @@ def export_excel(token: str):
 
     out_xlsx = RESULTS / f"{token}.xlsx"
     wb.save(str(out_xlsx))
-    return FileResponse(str(out_xlsx), filename=f"DXF_Check_{token}.xlsx",
-                        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    return out_xlsx
 
 @app.get("/export-pdf")
 def export_pdf(token: str):
     p = RESULTS / f"{token}.json"
     if not p.exists():
         return HTMLResponse("Token not found.", status_code=404)
-    data = safe_json_load(p)
-    result = data["result"]
-
+    timings: Dict[str, float] = {}
+    with timed(timings, "export_load"):
+        data = safe_json_load(p)
+    with timed(timings, "export_pdf"):
+        out_pdf = _build_pdf(token, data["result"])
+    return _timed_file_response(out_pdf, timings,
+                                filename=f"DXF_Check_{token}.pdf", media_type="application/pdf")
+
+def _build_pdf(token: str, result: dict) -> Path:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
     out_pdf = RESULTS / f"{token}.pdf"
     c = canvas.Canvas(str(out_pdf), pagesize=A4)
     w, h = A4
@@ -676,4 +1515,6 @@ def export_pdf(token: str):
 
     c.showPage()
     c.save()
-    return FileResponse(str(out_pdf), filename=f"DXF_Check_{token}.pdf", media_type="application/pdf")
+    return out_pdf
+
+STARTUP["import_s"] = round(time.perf_counter() - _IMPORT_T0, 3)
@@ -0,0 +1,175 @@
+# bench.py — قياس أداء الفاحص على ملفات DXF اصطناعية قابلة لإعادة الإنتاج
+# تشغيل: python bench.py --sizes 1000 10000 100000 --out bench_results.json
+#
+# يولّد لكل حجم ملفًا فيه خيام (غرف)، أبواب مباشرة ومتداخلة، أسهم مداخل/مخارج
+# وبوليلاين حد المكتب، ثم يقيس check_dxf (كاملًا ولكل مرحلة)، الفحص المتدفق،
+# generate_preview، وتصدير Excel و PDF. النتائج JSON لمقارنة التشغيلات بين الـ commits.
+
+import argparse, json, platform, random, subprocess, sys, tempfile, time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import ezdxf
+
+import app
+
+DOOR_BLOCK = "DOOR_90"
+NESTED_BLOCKS = ["DOOR_WRAP1", "DOOR_WRAP2", "DOOR_WRAP3"]   # عمق 1، 2، 3
+ARROW_BLOCK = "ARROW"
+
+
+def make_synthetic_dxf(path: Path, rooms: int, direct_doors: int, nested_doors: int,
+                       exits: int, enters: int, site_polys: int = 1, seed: int = 0) -> int:
+    """
+    يبني ملف DXF اصطناعيًا ويرجع عدد كيانات modelspace.
+    الخيام على شبكة منتظمة، والأبواب توزَّع على أول الخيام (باب واحد لكل خيمة).
+    """
+    rnd = random.Random(seed)
+    doc = ezdxf.new("R2010")
+
+    door = doc.blocks.new(DOOR_BLOCK)
+    door.add_line((0, 0), (0.9, 0))
+    door.add_arc((0, 0), 0.9, 0, 90)
+    parent = DOOR_BLOCK
+    for name in NESTED_BLOCKS:
+        blk = doc.blocks.new(name)
+        blk.add_blockref(parent, (0.2, 0.2), dxfattribs={"rotation": 15})
+        parent = name
+    arrow = doc.blocks.new(ARROW_BLOCK)
+    arrow.add_line((0, 0), (1, 0))
+    arrow.add_line((1, 0), (0.7, 0.2))
+
+    msp = doc.modelspace()
+    cols = max(1, int(rooms ** 0.5))
+    pitch = 5.0
+    width = cols * pitch
+    height = (rooms // cols + 1) * pitch
+    for i in range(site_polys):
+        o = -10.0 - i
+        msp.add_lwpolyline([(o, o), (width - o, o), (width - o, height - o), (o, height - o)],
+                           close=True, dxfattribs={"layer": app.SITE_BOUNDARY_LAYER})
+
+    for i in range(rooms):
+        x, y = (i % cols) * pitch, (i // cols) * pitch
+        w, h = rnd.choice([1.2, 2.0, 3.0]), rnd.choice([1.5, 2.0, 3.0])
+        msp.add_lwpolyline([(x, y), (x + w, y), (x + w, y + h), (x, y + h)],
+                           close=True, dxfattribs={"layer": "tent-A"})
+        if i < direct_doors:
+            msp.add_blockref(DOOR_BLOCK, (x + 0.2, y + 0.1),
+                             dxfattribs={"rotation": rnd.choice([0, 90, 180, 270])})
+        elif i < direct_doors + nested_doors:
+            msp.add_blockref(NESTED_BLOCKS[(i - direct_doors) % len(NESTED_BLOCKS)], (x, y),
+                             dxfattribs={"xscale": rnd.choice([1, -1])})
+
+    for i in range(exits):
+        msp.add_blockref(ARROW_BLOCK, (i * 2.0, -5.0), dxfattribs={"layer": app.EXIT_LAYER})
+    for i in range(enters):
+        msp.add_blockref(ARROW_BLOCK, (i * 2.0, -7.0), dxfattribs={"layer": app.ENTER_LAYER})
+
+    doc.saveas(path)
+    return len(msp)
+
+
+def counts_for_size(entities: int) -> Dict[str, int]:
+    """يوزّع عددًا إجماليًا من الكيانات: نصفها خيام، وثلثها أبواب مباشرة، والباقي متداخلة وأسهم."""
+    rooms = max(1, entities // 2)
+    direct = rooms * 2 // 3
+    arrows = max(2, entities // 100)
+    nested = max(0, entities - rooms - direct - arrows - 1)
+    return {"rooms": rooms, "direct_doors": direct, "nested_doors": min(nested, rooms - direct),
+            "exits": arrows // 2, "enters": arrows - arrows // 2}
+
+
+def _best(fn, repeat: int):
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def bench_size(size: int, workdir: Path, repeat: int, skip_preview: bool) -> Dict[str, Any]:
+    counts = counts_for_size(size)
+    path = workdir / f"bench_{size}.dxf"
+    entities = make_synthetic_dxf(path, **counts)
+    run: Dict[str, Any] = {
+        "size": size,
+        "entities": entities,
+        "file_mb": round(path.stat().st_size / 1e6, 2),
+        "layout": counts,
+    }
+
+    t, result = _best(lambda: app.check_dxf(str(path)), repeat)
+    run["check_dxf_s"] = round(t, 4)
+    run["check_stages_s"] = result["timings"]
+    run["rooms"] = result["total_rooms"]
+    run["passed"] = result["passed_rooms"]
+
+    t, _ = _best(lambda: app.stream_check_dxf(str(path)), repeat)
+    run["stream_check_s"] = round(t, 4)
+
+    token = f"bench_{size}"
+    if not skip_preview:
+        doc = ezdxf.readfile(str(path))
+        png = workdir / f"{token}.png"
+        t, (ok, err) = _best(lambda: app.generate_preview(path, png, doc=doc), repeat)
+        run["preview_s"] = round(t, 4)
+        run["preview_ok"] = ok
+
+    t, xlsx = _best(lambda: app._build_excel(token, result), repeat)
+    run["export_excel_s"] = round(t, 4)
+    t, pdf = _best(lambda: app._build_pdf(token, result), repeat)
+    run["export_pdf_s"] = round(t, 4)
+    for p in (xlsx, pdf):
+        Path(p).unlink(missing_ok=True)
+
+    run["peak_rss_mb"] = app.peak_rss_mb()
+    return run
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="DXF checker benchmark")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                    help="عدد كيانات modelspace لكل ملف")
+    ap.add_argument("--repeat", type=int, default=1, help="عدد التكرار (يُؤخذ الأسرع)")
+    ap.add_argument("--skip-preview", action="store_true", help="تخطي المعاينة (بطيئة على الأحجام الكبيرة)")
+    ap.add_argument("--workdir", type=Path, default=None, help="مجلد الملفات المولّدة (افتراضيًا مؤقت)")
+    ap.add_argument("--out", type=Path, default=Path("bench_results.json"))
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        runs = []
+        for size in args.sizes:
+            run = bench_size(size, workdir, args.repeat, args.skip_preview)
+            preview = f"{run['preview_s']:.3f}s" if "preview_s" in run else "-"
+            print(f"{size:>8} entities: check {run['check_dxf_s']:.3f}s  "
+                  f"stream {run['stream_check_s']:.3f}s  preview {preview}  "
+                  f"xlsx {run['export_excel_s']:.3f}s  pdf {run['export_pdf_s']:.3f}s", flush=True)
+            runs.append(run)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "ezdxf": ezdxf.__version__,
+        "platform": platform.platform(),
+        "runs": runs,
+    }
+    args.out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"-> {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())